@@ -7,15 +7,21 @@ Create CMS 2015 HI ppref collision dataset records.
 """
 
 import click
+import collections
+import concurrent.futures
 import csv
 import json
+import multiprocessing
 import os
 import re
-import subprocess
 import sys
 import urllib.parse
 import zlib
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from create_eos_file_indexes import (
     XROOTD_URI_BASE,
@@ -23,6 +29,8 @@ from create_eos_file_indexes import (
     get_dataset_location,
 )
 
+DATASET_RE = re.compile(r"^/(.*)/(.*?)-(.*?)/(.*)$")
+
 recid_freerange_start = 24600
 recid_validated_runs_full_validation = 14212
 recid_validated_runs_muons_only = 14213
@@ -33,7 +41,7 @@ collision_energy = "5.02TeV"
 collision_type = "pp"
 year_published = "2023"
 
-FWYZARD = {}
+FWYZARD = collections.defaultdict(list)
 
 SELECTION_DESCRIPTIONS = {}
 
@@ -43,6 +51,8 @@ try:
 except FileNotFoundError:
     pass
 
+LINKS_BY_DATASET = collections.defaultdict(list)
+
 DOI_INFO = {}
 
 RUNNUMBER_CACHE = {}
@@ -53,60 +63,56 @@ RECOCMSSW_CACHE = {}
 
 RECOGLOBALTAG_CACHE = {}
 
-
-def get_from_deep_json(data, akey):
-    "Traverse DATA and return first value matching AKEY."
-    if type(data) is dict:
-        if akey in data.keys():
-            return data[akey]
-        else:
-            for val in data.values():
-                if type(val) is dict:
-                    aval = get_from_deep_json(val, akey)
-                    if aval:
-                        return aval
-                if type(val) is list:
-                    for elem in val:
-                        aval = get_from_deep_json(elem, akey)
-                        if aval:
-                            return aval
-    if type(data) is list:
-        for elem in data:
-            aval = get_from_deep_json(elem, akey)
-            if aval:
-                return aval
-    return None
+INDEXFILES_CACHE = collections.defaultdict(list)
+
+
+def get_all_from_deep_json(data, akeys):
+    """Traverse DATA once and return {akey: first value} for the AKEYS found.
+
+    For each key, the search stops at the first dict holding it; an empty
+    value there is skipped together with the rest of that dict's subtree.
+    """
+    found = {}
+    stack = [(data, tuple(akeys))]
+    while stack and len(found) < len(akeys):
+        node, node_akeys = stack.pop()
+        node_type = type(node)
+        if node_type is dict:
+            child_akeys = []
+            for akey in node_akeys:
+                if akey in found:
+                    continue
+                if akey in node:
+                    if node[akey]:
+                        found[akey] = node[akey]
+                else:
+                    child_akeys.append(akey)
+            if child_akeys:
+                stack.extend((val, child_akeys) for val in reversed(node.values()))
+        elif node_type is list:
+            stack.extend((elem, node_akeys) for elem in reversed(node))
+    return found
+
+
+def load_json(filepath):
+    "Return content of the JSON file, parsed with orjson if it is available."
+    with open(filepath, "rb") as filestream:
+        if orjson:
+            return orjson.loads(filestream.read())
+        return json.load(filestream)
 
 
 def get_das_store_json(dataset):
     "Return DAS JSON from the DAS JSON Store for the given dataset."
     filepath = "./inputs/das-json-store/" + dataset.replace("/", "@") + ".json"
-    with open(filepath, "r") as filestream:
-        return json.load(filestream)
-
+    return load_json(filepath)
 
-def get_number_events(dataset):
-    """Return number of events for the dataset."""
-    number_events = get_from_deep_json(get_das_store_json(dataset), "nevents")
-    if number_events:
-        return number_events
-    return 0
 
-
-def get_number_files(dataset):
-    """Return number of files for the dataset."""
-    number_files = get_from_deep_json(get_das_store_json(dataset), "nfiles")
-    if number_files:
-        return number_files
-    return 0
-
-
-def get_size(dataset):
-    """Return size of the dataset."""
-    size = get_from_deep_json(get_das_store_json(dataset), "size")
-    if size:
-        return size
-    return 0
+def get_dataset_stats(dataset):
+    """Return number of events, number of files and size of the dataset."""
+    akeys = ("nevents", "nfiles", "size")
+    stats = get_all_from_deep_json(get_das_store_json(dataset), akeys)
+    return {akey: stats.get(akey, 0) for akey in akeys}
 
 
 def get_file_size(afile):
@@ -116,130 +122,153 @@ def get_file_size(afile):
 
 def get_file_checksum(afile):
     """Return the ADLER32 checksum of a file."""
-    return hex(zlib.adler32(open(afile, "rb").read(), 1) & 0xFFFFFFFF)[2:].zfill(8)
+    checksum = 1
+    with open(afile, "rb") as filestream:
+        for chunk in iter(lambda: filestream.read(1 << 20), b""):
+            checksum = zlib.adler32(chunk, checksum)
+    return f"{checksum & 0xFFFFFFFF:08x}"
 
 
 def populate_fwyzard():
     """Populate FWYZARD dictionary (dataset -> trigger list)."""
     if os.path.exists("./inputs/hlt-2015-hi-ppref-datasets.txt"):
-        for line in open("./inputs/hlt-2015-hi-ppref-datasets.txt", "r").readlines():
-            line = line.strip()
-            dataset, trigger = line.split(",")
-            if dataset in FWYZARD.keys():
+        with open("./inputs/hlt-2015-hi-ppref-datasets.txt", "r") as f:
+            for line in f:
+                dataset, trigger = line.strip().split(",")
                 FWYZARD[dataset].append(trigger)
-            else:
-                FWYZARD[dataset] = [
-                    trigger,
-                ]
 
 
 def populate_doiinfo():
     """Populate DOI_INFO dictionary (dataset -> doi)."""
-    for line in open("./inputs/doi-col.txt", "r").readlines():
-        dataset, doi = line.split()
-        DOI_INFO[dataset] = doi
+    with open("./inputs/doi-col.txt", "r") as f:
+        for line in f:
+            dataset, doi = line.split()
+            DOI_INFO[dataset] = doi
 
 
 def populate_runnumber_cache():
     """Populate RUNNUMBER cache (dataset -> run_numbers)"""
     dataset = ""
     values = []
-    for line in open("../cms-YYYY-run-numbers/inputs/allruns.txt", "r").readlines():
-        line = line.strip()
-        if line.startswith("/"):
-            # finish information about the dataset
-            if dataset in RUNNUMBER_CACHE.keys():
-                print(f"[ERROR] {dataset} existing several times in the input file.")
-            else:
-                if len(values):
-                    values.sort()
-                    RUNNUMBER_CACHE[dataset] = values
-            # start reading new dataset
-            dataset = line
-            values = []
-        else:
-            values.append(str(line))
+    with open("../cms-YYYY-run-numbers/inputs/allruns.txt", "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("/"):
+                # finish information about the dataset
+                if dataset in RUNNUMBER_CACHE.keys():
+                    print(
+                        f"[ERROR] {dataset} existing several times in the input file."
+                    )
+                else:
+                    if len(values):
+                        values.sort(key=int)
+                        RUNNUMBER_CACHE[dataset] = values
+                # start reading new dataset
+                dataset = line
+                values = []
+            elif line:
+                values.append(line)
 
 
 def populate_containerimages_cache():
     """Populate CONTAINERIMAGES cache (dataset -> system_details.container_images)"""
-    with open("../cms-release-info/cms_release_container_images_info.json") as f:
-        content = json.loads(f.read())
-        for key in content.keys():
-            CONTAINERIMAGES_CACHE[key] = content[key]
+    content = load_json("../cms-release-info/cms_release_container_images_info.json")
+    for key in content.keys():
+        CONTAINERIMAGES_CACHE[key] = content[key]
 
 
 def populate_recocmssw_cache():
     """Populate CMSSWRECO cache (reco_file_name -> cmssw)"""
-    for line in open("./inputs/reco-config-files-cmssw.csv", "r").readlines():
-        line = line.strip()
-        reco, cmssw = line.split(" ")
-        reco = reco.replace(".py", "")
-        RECOCMSSW_CACHE[reco] = cmssw
+    with open("./inputs/reco-config-files-cmssw.csv", "r") as f:
+        for line in f:
+            line = line.strip()
+            reco, cmssw = line.split(" ")
+            reco = reco.replace(".py", "")
+            RECOCMSSW_CACHE[reco] = cmssw
 
 
 def populate_recoglobaltag_cache():
     """Populate CMSSWGLOBALTAG cache (reco_file_name -> global tag)"""
-    for line in open("./inputs/reco-config-files-globaltag.csv", "r").readlines():
-        line = line.strip()
-        reco, global_tag = line.split(" ")
-        reco = reco.replace(".py", "")
-        RECOGLOBALTAG_CACHE[reco] = global_tag
+    with open("./inputs/reco-config-files-globaltag.csv", "r") as f:
+        for line in f:
+            line = line.strip()
+            reco, global_tag = line.split(" ")
+            reco = reco.replace(".py", "")
+            RECOGLOBALTAG_CACHE[reco] = global_tag
+
+
+def populate_indexfiles_cache():
+    """Populate INDEXFILES cache (dataset_index_file_base -> index file names)"""
+    if os.path.exists("./inputs/eos-file-indexes/"):
+        for afile in sorted(os.listdir("./inputs/eos-file-indexes/")):
+            # index file names are "<base>_<volume>_file_index.<ext>"
+            dataset_index_file_base = afile.rsplit("_", 3)[0]
+            INDEXFILES_CACHE[dataset_index_file_base].append(afile)
+
+
+def populate_links_by_dataset():
+    """Populate LINKS_BY_DATASET dictionary (dataset -> reco config file links)."""
+    for reco_link in LINK_INFO.keys():
+        # e.g. "reco_Run2015E_HIForward_1" is listed under "Run2015E" and "HIForward"
+        for token in dict.fromkeys(reco_link.split("_")[1:-1]):
+            LINKS_BY_DATASET[token].append(reco_link)
 
 
 def populate_selection_descriptions():
     """Populate SELECTION_DESCRIPTIONS dictionary (dataset -> selection description)."""
-    for input_file in [
-        "./inputs/CMSDatasetDescription_Run2015E.csv",
-    ]:
+    for input_file in ("./inputs/CMSDatasetDescription_Run2015E.csv",):
         if os.path.exists(input_file):
             with open(input_file, "r") as csvfile:
                 for line_values in csv.reader(csvfile, delimiter=":"):
+                    if len(line_values) != 2:
+                        continue
                     dataset, description = line_values
                     SELECTION_DESCRIPTIONS[dataset] = description
 
 
 def create_selection_information(dataset, dataset_full_name):
     """Create box with selection information."""
-    out = ""
+    out = []
     # description:
     description = SELECTION_DESCRIPTIONS.get(dataset_full_name, "")
     if description:
-        out += f"<p>{description}</p>"
+        out.append(f"<p>{description}</p>")
     # data taking / HLT:
-    out += "<p><strong>Data taking / HLT</strong>"
-    out += f'<br/>The collision data were assigned to different RAW datasets using the following <a href="/record/{recid_hlt_trigger_configuration}">HLT configuration</a>.</p>'
+    out.append("<p><strong>Data taking / HLT</strong>")
+    out.append(
+        f'<br/>The collision data were assigned to different RAW datasets using the following <a href="/record/{recid_hlt_trigger_configuration}">HLT configuration</a>.</p>'
+    )
     # data processing / RECO:
     process = "RECO"
-    for reco_link in LINK_INFO.keys():
-        if f"_{dataset}_" not in reco_link:
-            continue
-        generator_text = "Configuration file for " + process + " step " + reco_link
+    for reco_link in LINKS_BY_DATASET.get(dataset, []):
+        generator_text = f"Configuration file for {process} step {reco_link}"
         release = RECOCMSSW_CACHE[reco_link]
         global_tag = RECOGLOBALTAG_CACHE[reco_link]
-        out += "<p><strong>Data processing / RECO</strong>"
-        out += "<br/>This primary AOD dataset was processed from the RAW dataset by the following step (the run number in the configuration file name indicates the first run it was applied to): "
-        out += "<br/>Step: %s" % process
-        out += "<br/>Release: %s" % release
-        out += "<br/>Global tag: %s" % global_tag
-        out += '\n        <br/><a href="/record/%s">%s</a>' % (
-            LINK_INFO[reco_link],
-            generator_text,
+        out.append("<p><strong>Data processing / RECO</strong>")
+        out.append(
+            "<br/>This primary AOD dataset was processed from the RAW dataset by the following step (the run number in the configuration file name indicates the first run it was applied to): "
         )
-        out += "\n        </p>"
+        out.append(f"<br/>Step: {process}")
+        out.append(f"<br/>Release: {release}")
+        out.append(f"<br/>Global tag: {global_tag}")
+        out.append(
+            f'\n        <br/><a href="/record/{LINK_INFO[reco_link]}">{generator_text}</a>'
+        )
+        out.append("\n        </p>")
     # HLT trigger paths:
-    out += "<p><strong>HLT trigger paths</strong>"
-    out += '<br/>The possible <a href="/docs/cms-guide-trigger-system#hlt-trigger-path-definitions">HLT trigger paths</a> in this dataset are:'
+    out.append("<p><strong>HLT trigger paths</strong>")
+    out.append(
+        '<br/>The possible <a href="/docs/cms-guide-trigger-system#hlt-trigger-path-definitions">HLT trigger paths</a> in this dataset are:'
+    )
     trigger_paths = get_trigger_paths_for_dataset(dataset)
     for trigger_path in trigger_paths:
         if trigger_path.endswith("_v"):
             trigger_path = trigger_path[:-2]
-        out += '<br/><a href="/search?q=%s&type=Supplementaries&year=2015">%s</a>' % (
-            trigger_path,
-            trigger_path,
+        out.append(
+            f'<br/><a href="/search?q={trigger_path}&type=Supplementaries&year=2015">{trigger_path}</a>'
         )
-    out += "</p>"
-    return out
+    out.append("</p>")
+    return "".join(out)
 
 
 def get_trigger_paths_for_dataset(dataset):
@@ -251,19 +280,11 @@ def get_dataset_index_files(dataset_full_name):
     """Return list of dataset file information {path,size} for the given dataset."""
     files = []
     dataset_index_file_base = get_dataset_index_file_base(dataset_full_name)
-    output = subprocess.getoutput(
-        "ls ./inputs/eos-file-indexes/ | grep " + dataset_index_file_base
-    )
-    for line in output.split("\n"):
-        afile = line.strip()
+    dataset_location = get_dataset_location(dataset_full_name)
+    for afile in INDEXFILES_CACHE.get(dataset_index_file_base, []):
         if afile.endswith(".txt") or afile.endswith(".json"):
             # take only TXT files
-            afile_uri = (
-                XROOTD_URI_BASE
-                + get_dataset_location(dataset_full_name)
-                + "/file-indexes/"
-                + afile
-            )
+            afile_uri = XROOTD_URI_BASE + dataset_location + "/file-indexes/" + afile
             afile_size = get_file_size("./inputs/eos-file-indexes/" + afile)
             afile_checksum = get_file_checksum("./inputs/eos-file-indexes/" + afile)
             files.append((afile_uri, afile_size, afile_checksum))
@@ -280,17 +301,17 @@ def create_record(recid, dataset_full_name):
 
     rec = {}
 
-    m = re.match(r"^/(.*)\/(.*?)-(.*?)/(.*)$", dataset_full_name)
+    m = DATASET_RE.match(dataset_full_name)
     if not m:
-        print(f"[ERROR] Cannot parse dataset {dataset}.")
+        print(f"[ERROR] Cannot parse dataset {dataset_full_name}.")
         sys.exit()
-    dataset_short = str(m.groups(1)[0])
-    dataset_runperiod = str(m.groups(1)[1])
-    dataset_version = str(m.groups(1)[2])
-    dataset_format = str(m.groups(1)[3])
+    dataset_short = m.group(1)
+    dataset_runperiod = m.group(2)
+    dataset_version = m.group(3)
+    dataset_format = m.group(4)
 
     dataset_runperiod_year = dataset_runperiod[3:7]
-    dataset_runperiod_runx = dataset_runperiod.replace(dataset_runperiod_year, "")
+    dataset_runperiod_runx = dataset_runperiod[:3] + dataset_runperiod[7:]
 
     rec["abstract"] = {}
     rec["abstract"]["description"] = (
@@ -332,18 +353,23 @@ def create_record(recid, dataset_full_name):
 
     rec["distribution"] = {}
     rec["distribution"]["formats"] = ["aod", "root"]
-    rec["distribution"]["number_events"] = get_number_events(dataset_full_name)
-    rec["distribution"]["number_files"] = get_number_files(dataset_full_name)
-    rec["distribution"]["size"] = get_size(dataset_full_name)
+    dataset_stats = get_dataset_stats(dataset_full_name)
+    rec["distribution"]["number_events"] = dataset_stats["nevents"]
+    rec["distribution"]["number_files"] = dataset_stats["nfiles"]
+    rec["distribution"]["size"] = dataset_stats["size"]
 
     rec["doi"] = get_doi(dataset_full_name)
 
     rec["experiment"] = "CMS"
 
     rec["files"] = []
-    rec_files = get_dataset_index_files(dataset_full_name)
-    for index_type in [".json", ".txt"]:
-        index_files = [f for f in rec_files if f[0].endswith(index_type)]
+    index_files_by_type = {".json": [], ".txt": []}
+    for rec_file in get_dataset_index_files(dataset_full_name):
+        for index_type, index_files in index_files_by_type.items():
+            if rec_file[0].endswith(index_type):
+                index_files.append(rec_file)
+                break
+    for index_type, index_files in index_files_by_type.items():
         for file_number, (file_uri, file_size, file_checksum) in enumerate(index_files):
             rec["files"].append(
                 {
@@ -441,25 +467,28 @@ def create_record(recid, dataset_full_name):
 
 def create_records(dataset_full_names):
     """Create records."""
-    records = []
-    recid = recid_freerange_start
-    for dataset_full_name in dataset_full_names:
-        records.append(create_record(recid, dataset_full_name))
-        recid += 1
-    return records
+    recids = range(
+        recid_freerange_start, recid_freerange_start + len(dataset_full_names)
+    )
+    # fork so that workers inherit the caches populated in main()
+    with concurrent.futures.ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        return list(executor.map(create_record, recids, dataset_full_names))
 
 
 def print_records(records):
     """Print records."""
-    print(
-        json.dumps(
-            records,
-            indent=2,
-            sort_keys=True,
-            ensure_ascii=False,
-            separators=(",", ": "),
-        )
+    # json.dump writes the encoded chunks as they are produced
+    json.dump(
+        records,
+        sys.stdout,
+        indent=2,
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ": "),
     )
+    sys.stdout.write("\n")
 
 
 @click.command()
@@ -472,11 +501,13 @@ def main():
     populate_containerimages_cache()
     populate_recocmssw_cache()
     populate_recoglobaltag_cache()
+    populate_indexfiles_cache()
+    populate_links_by_dataset()
     populate_selection_descriptions()
 
     with open("./inputs/cms-2015-collision-datasets-hi-ppref.txt", "r") as f:
         dataset_full_names = []
-        for line in f.readlines():
+        for line in f:
             dataset_full_names.append(line.strip())
         records = create_records(dataset_full_names)
         print_records(records)